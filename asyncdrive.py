@@ -0,0 +1,135 @@
+from __future__ import annotations
+import asyncio
+import json
+from typing import AsyncIterator, Callable, List, Optional
+
+import aiohttp
+from pydrive.auth import GoogleAuth
+
+''' Brief readme Note:
+    An asyncio client for the (v2) Drive API, used by googdrivecheck.run_with_async_query.
+    Files come back as plain dicts with the same fields pydrive returns, so SafeFile works on them unchanged.
+    - All requests share one aiohttp session, whose connection pool keeps connections alive between requests
+    - At most max_in_flight requests are outstanding at once
+    - iter_file_pages() requests the next page before yielding the current one, so listing overlaps
+        with whatever the caller does with each page
+    - base_url can point at a local HTTP server (e.g. for testing)
+'''
+
+drive_v2_url = "https://www.googleapis.com/drive/v2"
+
+# Responses worth retrying (rate limiting and server side errors)
+retryable_http_statuses = [429, 500, 502, 503, 504]
+# Drive also rate limits with a 403, told apart from other 403s (e.g. insufficientPermissions) by its reason
+rate_limit_reasons = ["rateLimitExceeded", "userRateLimitExceeded"]
+# Transport failures worth retrying (e.g. a kept-alive connection reset by the server, or a timeout)
+retryable_exceptions = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+def is_retryable_error(status: int, error_body: str) -> bool:
+    """ Whether a failed request is worth retrying, given its HTTP status and (json) error body """
+    if status in retryable_http_statuses:
+        return True
+    if status != 403:
+        return False
+    try:
+        errors = json.loads(error_body)['error']['errors']
+        return any(error.get('reason') in rate_limit_reasons for error in errors)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+
+def pydrive_token_provider(gauth: GoogleAuth) -> Callable[[], str]:
+    """ Returns a callable giving a valid access token for an authenticated GoogleAuth, refreshing it if needed """
+    def _token() -> str:
+        if gauth.access_token_expired:
+            gauth.Refresh()
+        return gauth.credentials.access_token
+    return _token
+
+
+class AsyncDriveClient:
+    """
+    Use as an async context manager:
+        async with AsyncDriveClient(token_provider) as client:
+            async for file_list in client.iter_file_pages(query): ...
+    """
+    def __init__(self, token_provider: Callable[[], str], base_url: str = drive_v2_url,
+                 max_in_flight: int = 16, max_try_count: int = 5, backoff_seconds: float = 1):
+        self.token_provider = token_provider
+        self.base_url = base_url.rstrip("/")
+        self.max_in_flight = max_in_flight
+        self.max_try_count = max_try_count
+        self.backoff_seconds = backoff_seconds     # Retry n waits backoff_seconds * 2**n
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> AsyncDriveClient:
+        # The connector pool matches the in flight limit so that every request can reuse a kept-alive connection
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        self._session = aiohttp.ClientSession(connector=connector)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._session = None
+
+    async def _request(self, method: str, path: str, params: Optional[dict] = None) -> Optional[dict]:
+        """ Issues one API request, retrying with backoff. Returns the decoded json (None for an empty response) """
+        if params is not None:
+            params = {k: str(v) for k, v in params.items()}
+
+        try_count = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    headers = {'Authorization': "Bearer " + self.token_provider()}
+                    async with self._session.request(method, self.base_url + path,
+                                                     params=params, headers=headers) as response:
+                        if response.status < 400:
+                            if response.status == 204:
+                                return None
+                            return await response.json(content_type=None)
+                        error_text = await response.text()
+            except retryable_exceptions as e:
+                try_count += 1
+                if try_count >= self.max_try_count:
+                    raise Exception("Drive API request failed for %s %s: %r" % (method, path, e))
+                await asyncio.sleep(self.backoff_seconds * 2 ** try_count)
+                continue
+
+            try_count += 1
+            if not is_retryable_error(response.status, error_text) or try_count >= self.max_try_count:
+                raise Exception("Drive API error %d for %s %s: %s" % (response.status, method, path, error_text))
+            # Back off outside the semaphore so others can proceed
+            await asyncio.sleep(self.backoff_seconds * 2 ** try_count)
+
+    async def iter_file_pages(self, query: dict) -> AsyncIterator[List[dict]]:
+        """ Yields pages (lists of file dicts) for a files.list query, e.g. {'maxResults': 1000, 'q': '...'} """
+        params = dict(query)
+        next_page = asyncio.ensure_future(self._request("GET", "/files", params))
+        try:
+            while next_page is not None:
+                response = await next_page
+                next_page = None
+                page_token = response.get('nextPageToken')
+                if page_token:
+                    params = dict(query, pageToken=page_token)
+                    next_page = asyncio.ensure_future(self._request("GET", "/files", params))
+                yield response.get('items', [])
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def get_metadata(self, file_id: str, fields: Optional[str] = None) -> dict:
+        params = {'fields': fields} if fields is not None else None
+        return await self._request("GET", "/files/%s" % file_id, params)
+
+    async def list_permissions(self, file_id: str) -> List[dict]:
+        response = await self._request("GET", "/files/%s/permissions" % file_id)
+        return response.get('items', [])
+
+    async def delete_permission(self, file_id: str, permission_id: str):
+        await self._request("DELETE", "/files/%s/permissions/%s" % (file_id, permission_id))
@@ -0,0 +1,86 @@
+import csv
+import heapq
+import os
+import sys
+import tempfile
+from operator import itemgetter
+from typing import Iterable, Iterator, List
+
+''' Brief readme Note:
+    Sorts rows that may not fit in memory (used for the folder csv in googdrivecheck.py).
+    Rows are buffered until they use about memory_budget_bytes, then sorted and written to a temporary
+    file (a "run"). At the end all runs are k-way merged. If everything fits in the budget, nothing is
+    written to disk. Like sorted(), ties keep their input order.
+'''
+
+# Most runs merged at once. More runs than this are first merged into larger runs (bounds open files)
+max_merge_fan_in = 64
+
+
+def _row_size(row: List[str]) -> int:
+    """ Rough in memory size of a row of strings """
+    return sys.getsizeof(row) + sum(sys.getsizeof(x) for x in row)
+
+
+def _write_run(rows: Iterable[List[str]], tmp_dir) -> str:
+    fd, run_file_name = tempfile.mkstemp(prefix="sortrun_", suffix=".csv", dir=tmp_dir)
+    with os.fdopen(fd, "w", newline="") as run_file:
+        csv.writer(run_file).writerows(rows)
+    return run_file_name
+
+
+def _merge_runs(run_file_names: List[str]) -> Iterator[List[str]]:
+    run_files = [open(x, "r", newline="") for x in run_file_names]
+    try:
+        yield from heapq.merge(*[csv.reader(x) for x in run_files], key=itemgetter(0))
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+
+def external_sort(rows: Iterable[List[str]], memory_budget_bytes: int, tmp_dir=None) -> Iterator[List[str]]:
+    """
+    Yields rows sorted by their first column. All fields must be strings.
+
+    :param rows: the rows to sort
+    :param memory_budget_bytes: about how much memory the buffered rows may use
+    :param tmp_dir: where to write runs (defaults to the system temp directory)
+    """
+    run_file_names: List[str] = []
+    try:
+        buffer = []
+        buffer_size = 0
+        for row in rows:
+            buffer.append(row)
+            buffer_size += _row_size(row)
+            if buffer_size >= memory_budget_bytes:
+                buffer.sort(key=itemgetter(0))
+                run_file_names.append(_write_run(buffer, tmp_dir))
+                buffer = []
+                buffer_size = 0
+
+        buffer.sort(key=itemgetter(0))
+        if len(run_file_names) == 0:
+            yield from buffer
+            return
+        if len(buffer) > 0:
+            run_file_names.append(_write_run(buffer, tmp_dir))
+        del buffer
+
+        # Merge level by level: each level merges consecutive groups of runs, so every row is rewritten once per
+        # level, and ties keep their input order because the runs stay in order
+        while len(run_file_names) > max_merge_fan_in:
+            merged_run_file_names = []
+            while len(run_file_names) > 0:
+                to_merge = run_file_names[:max_merge_fan_in]
+                merged_run_file_names.append(_write_run(_merge_runs(to_merge), tmp_dir))
+                for run_file_name in to_merge:
+                    os.remove(run_file_name)
+                run_file_names = run_file_names[max_merge_fan_in:]
+            run_file_names = merged_run_file_names
+
+        yield from _merge_runs(run_file_names)
+    finally:
+        for run_file_name in run_file_names:
+            if os.path.exists(run_file_name):
+                os.remove(run_file_name)
@@ -1,7 +1,9 @@
 from __future__ import annotations
 from pprint import pprint as pp
-from typing import Dict, List, NoReturn, Optional
+from typing import Dict, List, NamedTuple, NoReturn, Optional, Set, Tuple
+import asyncio
 import csv
+import gzip
 import pickle
 import yaml
 
@@ -13,9 +15,13 @@ from pydrive.drive import GoogleDrive, GoogleDriveFile
 # Drive defines "My Drive" as root, but backed up computers are not captured.
 from pydrive.files import GoogleDriveFileList
 
+from asyncdrive import AsyncDriveClient, pydrive_token_provider
+from externalsort import external_sort
+
 intense_debug = False   # Will print all files parsed
 run_short_test = False  # Run recurisvely over the tester_id folder / file provided in config, instead of
 print_tracked_files_to_std_out = False
+use_async_client = False  # Query through asyncdrive.py (run_with_async_query) instead of pydrive's ListFile
 # Over the whole API
 should_write_output = True
 
@@ -96,12 +102,13 @@ class FileProperties:
         "has_multiple_parents": False, # Whether file has multiple parent directories
         "file_size": 0,
 
-        # These are set in TrackedFile._fetch_metadata() (populated only if shared = True)
+        # These are set in TrackedFile.process_sharing_metadata() (populated only if shared = True)
+        # They are copied from the file's (shared) PermissionSet
         "has_more_than_one_permission" : False, # Whether file has more than one access permission. Equivalent to shared.
         "has_non_user_or_anyone_permission" : False,      # Whether file has a permission that is not use or anyone
         # As of this writing that is domain or group
         "has_link_sharing" : False,                       # Equivalent to having an 'anyone' permission
-        "users_groups_domains_with_access" : []           # Specific groups, users, domains with access
+        "users_groups_domains_with_access" : ()           # Specific groups, users, domains with access
     }
 
 
@@ -170,12 +177,12 @@ class SafeFile:
                len(SafeFile.safe_get(file, '_safe_parents')) == 0
 
     @classmethod
-    def get_full_path(cls, file:GoogleDriveFile, parent_folder: 'Folder') -> str:
+    def get_full_path(cls, file:GoogleDriveFile, parent_folder: 'Folder', memoise=True) -> str:
         file_name = SafeFile.safe_get(file, 'name')
         if parent_folder is None:
             return orphan_prefix + "/" + file_name
 
-        parent_folder_path = parent_folder.full_path
+        parent_folder_path = parent_folder.get_full_path(memoise)
         return parent_folder_path + "/" + file_name
 
     @classmethod
@@ -183,36 +190,39 @@ class SafeFile:
         owners = SafeFile.safe_get(file, 'owners')
         return list(x['displayName'] for x in owners)
 
+    # Sharing properties (link sharing, users / groups / domains with access, ...) are derived once per
+    # distinct set of permissions by PermissionSet. Permissions are dropped from the file once interned
     @classmethod
-    def has_link_sharing(cls, file:GoogleDriveFile) -> bool:
-        if "anyone" in SafeFile.non_user_permissions_type_list(file):
-            return True
-        return False
+    def set_permissions(cls, file: GoogleDriveFile, permissions: List[dict]):
+        """ Stores separately fetched permissions (e.g. from the async client) on the file """
+        file[SafeFile.property_mapping['permissions']] = permissions
 
     @classmethod
-    def non_user_permissions_type_list(cls, file:GoogleDriveFile) -> List[str]:
-        permissions = SafeFile.safe_get(file, 'permissions')
-        return list(perm['type']
-                    for perm in permissions if perm['type'] not in ["user"])
+    def drop_permissions(cls, file: GoogleDriveFile):
+        """ Frees the file's permissions array once it has been interned (see PermissionSetRegistry) """
+        internal_name_for_attr = SafeFile.property_mapping['permissions']
+        file.pop(internal_name_for_attr, None)
+        # pydrive keeps a second (shallow) copy of the fetched metadata
+        metadata = getattr(file, 'metadata', None)
+        if metadata is not None:
+            metadata.pop(internal_name_for_attr, None)
 
     @classmethod
-    # Todo: verify domain works
-    def special_permissions_list(cls, file:GoogleDriveFile) -> List[List[str]]:
-        permissions = SafeFile.safe_get(file, 'permissions')
-        return list([perm['type'],perm.get('emailAddress')]
-                    for perm in permissions if perm['type'] not in ["user", "anyone"])
+    def canonical_permission(cls, perm: dict) -> 'CanonicalPermission':
+        return CanonicalPermission(perm['type'], SafeFile.permission_principal(perm), perm.get('role', ""),
+                                   SafeFile.permission_id(perm))
 
     @classmethod
-    def users_groups_domains_with_access(cls, file:GoogleDriveFile) -> List[str]:
-        permissions = SafeFile.safe_get(file, 'permissions')
-        return_list = []
-        for perm in permissions:
-            if perm['type'] == "anyone": continue
+    def permission_principal(cls, perm: dict) -> str:
+        """ The user / group email, domain, or 'anyone' that a single permission grants access to """
+        if perm['type'] == "anyone": return "anyone"
+        if perm['type'] in ["user", "group"]: return perm.get('emailAddress', "")
+        if perm['type'] == "domain": return perm['domain']
+        raise Exception("Unhandled permission type: %s" % perm['type'])
 
-            if perm['type'] in ["user", "group"]: return_list.append(perm['emailAddress'])
-            elif perm['type'] == "domain": return_list.append(perm['domain'])
-            else: raise Exception("Unhandled permission type: %s" % perm['type'])
-        return return_list
+    @classmethod
+    def permission_id(cls, perm: dict) -> str:
+        return perm['id']
 
     @classmethod
     def file_size(cls, file:GoogleDriveFile) -> int:
@@ -223,8 +233,10 @@ class SafeFile:
         return file_size
 
     @classmethod
-    def review_and_maybe_generate_tracked_file(cls, file: GoogleDriveFile, parent: 'Folder') -> Optional['TrackedFile']:
-        """ Determine whether a given file should be tracked. If yes return TrackedFile"""
+    def review_and_maybe_generate_tracked_file(cls, file: GoogleDriveFile, parent: 'Folder',
+                                               fetch_sharing_metadata=True) -> Optional['TrackedFile']:
+        """ Determine whether a given file should be tracked. If yes return TrackedFile
+            With fetch_sharing_metadata=False the caller fetches sharing metadata (see TrackedFile)"""
         properties_dict = FileProperties.default_dict.copy()    #This was a big mistake
 
         if SafeFile.safe_get(file, 'shared'):
@@ -258,37 +270,108 @@ class SafeFile:
             properties_dict['file_size'] = file_size
 
         if True in properties_dict.values():
-            return TrackedFile(file, properties_dict, parent)
+            return TrackedFile(file, properties_dict, parent, fetch_sharing_metadata)
         return None
 
 
+class CanonicalPermission(NamedTuple):
+    type: str           # user, group, domain or anyone
+    principal: str      # See SafeFile.permission_principal
+    role: str
+    id: str
+
+
+class PermissionSet:
+    """An immutable, canonical (sorted) set of permissions. Files with identical permissions share one
+        PermissionSet (see PermissionSetRegistry), so the derived flags are computed once per distinct set
+    """
+    __slots__ = ('set_id', 'permissions', 'has_more_than_one_permission', 'has_non_user_or_anyone_permission',
+                 'has_link_sharing', 'users_groups_domains_with_access', 'special_permissions', 'principals')
+
+    def __init__(self, set_id: int, permissions: Tuple[CanonicalPermission, ...]):
+        self.set_id = set_id
+        self.permissions = permissions
+
+        self.has_more_than_one_permission = len(permissions) > 1
+        # Permissions that are not user or anyone. As of this writing that is domain or group
+        self.special_permissions = tuple((x.type, x.principal) for x in permissions if x.type not in ["user", "anyone"])
+        self.has_non_user_or_anyone_permission = len(self.special_permissions) > 0
+        self.has_link_sharing = any(x.type == "anyone" for x in permissions)
+        self.users_groups_domains_with_access = tuple(x.principal for x in permissions if x.type != "anyone")
+        # Lowercased (principal, type) pairs, for PrincipalAccessIndex
+        self.principals = tuple((x.principal.lower(), x.type) for x in permissions)
+
+    def __setattr__(self, key, value):
+        if hasattr(self, key):
+            raise AttributeError("PermissionSet is immutable")
+        object.__setattr__(self, key, value)
+
+    def __getstate__(self):
+        return (self.set_id, self.permissions)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return "PermissionSet %d: %s" % (self.set_id, list(self.permissions))
+
+
+# Interns permission sets: set_id => PermissionSet, one per distinct set of permissions
+# TrackedFile only keeps the set_id. Saved in pickleoutput.db (after principal_index)
+class PermissionSetRegistry:
+    def __init__(self):
+        self.sets: List[PermissionSet] = []
+        self._ids_by_permissions: Dict[Tuple[CanonicalPermission, ...], int] = dict()
+
+    def intern(self, permissions: List[dict]) -> PermissionSet:
+        canonical = tuple(sorted(set(SafeFile.canonical_permission(perm) for perm in permissions)))
+        set_id = self._ids_by_permissions.get(canonical)
+        if set_id is None:
+            set_id = len(self.sets)
+            self.sets.append(PermissionSet(set_id, canonical))
+            self._ids_by_permissions[canonical] = set_id
+        return self.sets[set_id]
+
+    def get(self, set_id: int) -> PermissionSet:
+        return self.sets[set_id]
+
+
 class TrackedFile:
     """A file that has a property we care about. Files without interesting properties are not tracked (save space)
         After being initialized, everything can be safely accessed. Generally set once and then read upon output
         Fetches sharing metadata only if needed
+        With fetch_sharing_metadata=False, the caller fetches permissions when needs_sharing_metadata is True,
+        stores them with SafeFile.set_permissions() and then calls process_sharing_metadata()
     """
     # Todo: complete the docstring of all methods
-    def __init__(self, file: GoogleDriveFile, properties_dictionary: dict, parent_folder: 'Folder'):
+    def __init__(self, file: GoogleDriveFile, properties_dictionary: dict, parent_folder: 'Folder',
+                 fetch_sharing_metadata=True):
         self.file = file
         self.props = properties_dictionary
         self.parent_folder = parent_folder
+        self.permission_set_id: Optional[int] = None   # Set once sharing metadata is processed
 
-        # Metadata fetch is expensive, so
-        # Only fetch sharing for files owned by us (if not owned by us, of course it's shared!) and that are shared
-        if not properties_dictionary['non_auth_user_file'] and properties_dictionary['shared']:
+        if fetch_sharing_metadata and self.needs_sharing_metadata:
             self._fetch_sharing_metadata()
 
+    # Metadata fetch is expensive, so
+    # Only fetch sharing for files owned by us (if not owned by us, of course it's shared!) and that are shared
+    @property
+    def needs_sharing_metadata(self) -> bool:
+        return not self.props['non_auth_user_file'] and self.props['shared']
+
     def __repr__(self):
         return SafeFile.safe_get(self.file, 'name') + "\n" + self.props.__repr__()
 
-    def tracked_file_csv_info(self):
+    def tracked_file_csv_info(self, memoise_path=True):
         # Copy over the props we already have, then add in other fields to write.
         # Todo: these fields must match those in the csv writing in main()
         output_dict = self.props.copy()
+        output_dict['users_groups_domains_with_access'] = list(self.props['users_groups_domains_with_access'])
         output_dict['name'] = SafeFile.safe_get(self.file,'name')
         output_dict['id'] = SafeFile.safe_get(self.file, 'id')
         output_dict['url'] = SafeFile.safe_get(self.file, 'url')
-        output_dict['fullpath'] = SafeFile.get_full_path(self.file, self.parent_folder)
+        output_dict['fullpath'] = SafeFile.get_full_path(self.file, self.parent_folder, memoise_path)
         output_dict['all_owners'] = SafeFile.get_all_owners(self.file)
         output_dict['is_folder'] = SafeFile.is_folder(self.file)
         return output_dict
@@ -296,7 +379,6 @@ class TrackedFile:
     # Internal method called only for files that are not owned by us and that are shared.
     def _fetch_sharing_metadata(self):
         file = self.file
-        is_shared = self.props['shared']
 
         # Some magic in case fetching fails
         fetch_success = False
@@ -320,23 +402,36 @@ class TrackedFile:
             print("fetches failed %d times. Abandoning" % fetch_try_count)
             return
 
+        self.process_sharing_metadata()
+
+    # Populates the sharing props from the file's (already fetched) permissions. The permissions are interned
+    # into a shared PermissionSet and then dropped from the file
+    def process_sharing_metadata(self):
+        file = self.file
+        is_shared = self.props['shared']
+
         has_more_than_one_permission = False   # This is not particularly useful
         has_non_user_or_anyone_permission = False        # This in general will match link_sharing, except in rare cases
         has_link_sharing = False
 
-        if len(SafeFile.safe_get(file, 'permissions')) > 1:
+        permission_set = permission_sets.intern(SafeFile.safe_get(file, 'permissions'))
+        self.permission_set_id = permission_set.set_id
+        SafeFile.drop_permissions(file)
+
+        if permission_set.has_more_than_one_permission:
             self.props['has_more_than_one_permission'] = True
 
-        special_permissions_info = SafeFile.special_permissions_list(file)
-        if len(special_permissions_info) > 0:
+        if permission_set.has_non_user_or_anyone_permission:
             print_file_note("non user-anyone permission type", file)
-            pp(special_permissions_info)
+            pp(permission_set.special_permissions)
             self.props['has_non_user_or_anyone_permission'] = True
 
-        if SafeFile.has_link_sharing(file):
+        if permission_set.has_link_sharing:
             self.props['has_link_sharing'] = True
 
-        self.props['users_groups_domains_with_access'] = SafeFile.users_groups_domains_with_access(file)
+        # Shared (immutable) tuple; not copied per file
+        self.props['users_groups_domains_with_access'] = permission_set.users_groups_domains_with_access
+        principal_index.add_file(file, permission_set)
 
         # Some verifications based on our expectations of how sharing works.
         # These can be removed; they have been verified in my experience
@@ -453,6 +548,11 @@ class Folder:
     # Recursively lookup fullpaths through the folder tree
     @property
     def full_path(self):
+        return self.get_full_path(memoise=True)
+
+    # With memoise=False the path (and its parents' paths) is built without being stored, so that the paths of
+    # all folders are not held in memory at once (see folder_csv_external_sort). Metadata lookups still happen
+    def get_full_path(self, memoise=True) -> str:
         # Quick fail if we've already done this node
         if self._full_path is not None:
             return self._full_path
@@ -464,26 +564,26 @@ class Folder:
 
         if self._metadata_lookup_failed:
             # This file is not "see-able". The folder.name will be name_for_non_seeable_folders
-            self._full_path = ".../" + self.name
-            return self._full_path
+            full_path = ".../" + self.name
 
         # Otherwise, file is seen and metadata was looked up. Now we populate the full_path
-        if self.parent is not None:
-            self._full_path = self.parent.full_path + "/" + self.name
-            return self._full_path
+        elif self.parent is not None:
+            full_path = self.parent.get_full_path(memoise) + "/" + self.name
 
         # If we are here, there are no more parents because it is root, orphaned, or error
-        if self.is_root:
-            self._full_path = self.name
+        elif self.is_root:
+            full_path = self.name
         elif self.is_orphan:
-            self._full_path = orphan_prefix + "/" + self.name
+            full_path = orphan_prefix + "/" + self.name
         # Else it's a metadata lookup failure
         # We should never get here, since metadata lookup failures already set the fullpath
         else:
             raise Exception("*** ERROR *** no parent (and not root or orphan) for id: %s\n"
                             "This is most likely a code error. We should not reach this point" % self.id)
 
-        return self._full_path
+        if memoise:
+            self._full_path = full_path
+        return full_path
 
     # Properties that require full metadata and lazily fetch it
     @lazy_property_folder_metadata
@@ -531,6 +631,18 @@ class Folder:
         self._total_size_all_contents += self.size_of_direct_children
         self._all_children_count += self.num_direct_children
 
+    def folder_csv_info(self, memoise_path=True):
+        # Todo: these fields must match those in the csv writing in main()
+        return {
+            'folder_name': self.name,
+            'id': self.id,
+            'url': self.url,
+            'fullpath': self.get_full_path(memoise_path),
+            'num_children': self.all_children_count,
+            'total_size': self.size_all_children,
+            'owners': self.owners
+        }
+
     # Additional recursive property. This could probably be built into a
     # single call with traverse_all_children if we traverse the right way.
     @property
@@ -551,8 +663,18 @@ class Folder:
 # A dictionary with a few new features. Not implemented in the prettiest way
 # Todo: this class is poorly named and a suboptimal way to organize this code
 class FolderTracker:
-    def __init__(self):
+    # The path settings are kept here so that pickleoutput.db can build paths without settings.yaml
+    def __init__(self, orphan_prefix: str, name_for_non_seeable_folders: str):
         self.data : Dict[str, Folder] = dict()
+        self.orphan_prefix = orphan_prefix
+        self.name_for_non_seeable_folders = name_for_non_seeable_folders
+
+    # Scripts reading pickleoutput.db (e.g. whohasaccess.py) call this after unpickling, so that
+    # full paths (which are not stored with folder_csv_external_sort) use the settings of the run that saved it
+    def restore_path_settings(self) -> NoReturn:
+        global orphan_prefix, name_for_non_seeable_folders
+        orphan_prefix = self.orphan_prefix
+        name_for_non_seeable_folders = self.name_for_non_seeable_folders
 
     # Look up without creation of a new folder if one doesn't exist
     def static_folder_lookup(self, folder_id, none_is_okay=False) -> Optional[Folder]:
@@ -575,7 +697,8 @@ class FolderTracker:
     # then creates folder for this file
     # This handles items the first time we see them
     # Todo: this should not be in this class. Logic duplicated with _do_lookup_from_drive
-    def log_item(self, file: GoogleDriveFile) -> NoReturn:
+    # fetch_sharing_metadata is passed on to TrackedFile
+    def log_item(self, file: GoogleDriveFile, fetch_sharing_metadata=True) -> NoReturn:
         file_id = SafeFile.safe_get(file, 'id')
         is_a_folder = SafeFile.is_folder(file)
         parent_id = SafeFile.get_parent_id(file)
@@ -598,14 +721,76 @@ class FolderTracker:
                 parent_folder.child_folders.append(folder)
 
         # Checks and potentially logs this file to be tracked
-        file_to_track = SafeFile.review_and_maybe_generate_tracked_file(file, parent_folder)
+        file_to_track = SafeFile.review_and_maybe_generate_tracked_file(file, parent_folder, fetch_sharing_metadata)
         if file_to_track is not None:
             tracked_files[file_id] = file_to_track
 
     # Postprocessing: recursively fill the paths for all folders
-    def populate_all_paths(self):
+    # With memoise=False paths are not stored; this only does the metadata lookups for folders never seen
+    def populate_all_paths(self, memoise=True):
         for folder in self.data.values():
-            _ = folder.full_path
+            _ = folder.get_full_path(memoise)
+
+
+class PrincipalAccess:
+    """The files and folders that a single principal (user, group, domain or 'anyone') has a permission on"""
+    def __repr__(self):
+        return "%s (%s): %d files, %d folders, %d bytes" % (
+            self.principal, self.principal_type, len(self.file_ids), len(self.folder_ids), self.total_bytes)
+
+    def __init__(self, principal: str, principal_type: str):
+        self.principal = principal
+        self.principal_type = principal_type
+        self.file_ids: Set[str] = set()       # Files that are not folders
+        self.folder_ids: Set[str] = set()
+        self.total_bytes = 0                  # Size of all files in file_ids
+
+    @property
+    def file_count(self):
+        return len(self.file_ids)
+
+    @property
+    def folder_count(self):
+        return len(self.folder_ids)
+
+
+# Inverted index: principal => PrincipalAccess
+# Populated as permissions are processed (TrackedFile.process_sharing_metadata), so it covers exactly
+# the files whose sharing metadata was fetched. Saved in pickleoutput.db; see whohasaccess.py
+class PrincipalAccessIndex:
+    def __init__(self):
+        self.data: Dict[str, PrincipalAccess] = dict()
+        # domain => principals (users, groups and the domain itself) in that domain
+        self.principals_by_domain: Dict[str, Set[str]] = dict()
+
+    def add_file(self, file: GoogleDriveFile, permission_set: PermissionSet):
+        file_id = SafeFile.safe_get(file, 'id')
+        is_a_folder = SafeFile.is_folder(file)
+        file_size = int(SafeFile.file_size(file))
+
+        for principal, principal_type in permission_set.principals:
+            access = self.data.get(principal)
+            if access is None:
+                access = PrincipalAccess(principal, principal_type)
+                self.data[principal] = access
+                if principal_type == "domain":
+                    self.principals_by_domain.setdefault(principal, set()).add(principal)
+                elif "@" in principal:
+                    self.principals_by_domain.setdefault(principal.split("@", 1)[1], set()).add(principal)
+
+            if is_a_folder:
+                access.folder_ids.add(file_id)
+            elif file_id not in access.file_ids:
+                access.file_ids.add(file_id)
+                access.total_bytes += file_size
+
+    # Principal is an email, a domain, or 'anyone' (link sharing)
+    def lookup(self, principal: str) -> Optional[PrincipalAccess]:
+        return self.data.get(principal.lower())
+
+    # The domain permission itself (if any) plus every user and group in the domain
+    def lookup_domain(self, domain: str) -> List[PrincipalAccess]:
+        return list(self.data[x] for x in sorted(self.principals_by_domain.get(domain.lower(), [])))
 
 
 def run_with_recursive_look_up(starting_id):
@@ -657,6 +842,8 @@ def run_with_query(query=""):
         total_all_files += len(file_list)
         print("Total parsed files: %d" % total_all_files)
         for file in file_list:
+            if intense_debug:
+                all_file_set.append(file)
             if SafeFile.is_folder(file):
                 total_folders += 1
             all_folders.log_item(file)
@@ -664,6 +851,93 @@ def run_with_query(query=""):
     print("Parsed %d files\t %d folders" % (total_all_files, total_folders))
 
 
+def run_with_async_query(query=""):
+    """
+    Same as run_with_query, but through the asyncio client in asyncdrive.py. Sharing metadata for tracked files
+    is fetched concurrently (up to async_max_in_flight_requests requests at once), while later pages are still
+    being listed and parsed
+
+    :param query:
+    """
+    if query == "":
+        q_string = "trashed=false"
+        query = {'maxResults': max_results_api_setting, 'q': q_string}
+
+    print("Running async API query with query:\n%s" % query)
+    asyncio.run(_async_query(query))
+
+
+async def _async_query(query: dict):
+    total_all_files = 0
+    total_folders = 0
+    sharing_fetches = []
+    async with AsyncDriveClient(pydrive_token_provider(gauth), max_in_flight=async_max_in_flight_requests,
+                                max_try_count=max_metadata_fetch_try_count) as client:
+        try:
+            async for file_list in client.iter_file_pages(query):
+                total_all_files += len(file_list)
+                print("Total parsed files: %d" % total_all_files)
+                for file in file_list:
+                    if intense_debug:
+                        all_file_set.append(file)
+                    if SafeFile.is_folder(file):
+                        total_folders += 1
+                    all_folders.log_item(file, fetch_sharing_metadata=False)
+
+                    file_to_track = tracked_files.get(SafeFile.safe_get(file, 'id'))
+                    if file_to_track is not None and file_to_track.needs_sharing_metadata:
+                        sharing_fetches.append(
+                            asyncio.ensure_future(_async_fetch_sharing_metadata(client, file_to_track)))
+        except BaseException:
+            # Listing failed (after the client's retries): don't leave the fetches running unawaited
+            for fetch in sharing_fetches:
+                fetch.cancel()
+            await asyncio.gather(*sharing_fetches, return_exceptions=True)
+            raise
+
+        print("Listing done. Waiting for %d sharing metadata fetches" % len(sharing_fetches))
+        await asyncio.gather(*sharing_fetches)
+
+    print("Parsed %d files\t %d folders" % (total_all_files, total_folders))
+
+
+async def _async_fetch_sharing_metadata(client: AsyncDriveClient, file_to_track: TrackedFile):
+    file = file_to_track.file
+    try:
+        permissions = await client.list_permissions(SafeFile.safe_get(file, 'id'))
+    except Exception as e:
+        # The client already retried; give up on this file like TrackedFile._fetch_sharing_metadata does
+        print("error fetching permissions for title: %s\t id: %s. Abandoning" %
+              (SafeFile.safe_get(file, 'name'), SafeFile.safe_get(file, 'id')))
+        print(str(e))
+        return
+
+    SafeFile.set_permissions(file, permissions)
+    file_to_track.process_sharing_metadata()
+
+
+def write_folder_csv_external_sort(csv_file, csv_columns: List[str]):
+    """
+    Writes the folder csv sorted by fullpath, with at most about folder_csv_memory_budget_mb of rows in memory
+    (see externalsort.py). Rows are written exactly as csv.DictWriter writes them in the in memory mode.
+    Paths are not memoised in this mode, so only the rows buffered for sorting hold paths
+
+    :param csv_file: open (text) file to write to
+    :param csv_columns: folder csv columns
+    """
+    def folder_rows():
+        for folder in all_folders.data.values():
+            folder.traverse_all_children()
+            row = folder.folder_csv_info(memoise_path=False)
+            # Sort key first. None is written as an empty field, like csv.DictWriter does
+            yield [row['fullpath']] + ["" if row[x] is None else str(row[x]) for x in csv_columns]
+
+    writer = csv.writer(csv_file)
+    writer.writerow(csv_columns)
+    for sorted_row in external_sort(folder_rows(), int(folder_csv_memory_budget_mb * 1024 * 1024)):
+        writer.writerow(sorted_row[1:])
+
+
 def main():
     """
       This is the main run
@@ -672,11 +946,13 @@ def main():
         print("Running short test. If this isn't what you want, change the flag inside googdrivecheck.py")
         print("Short test running with test_id (file or folder):\t %s" % tester_id)
         run_with_recursive_look_up(tester_id)
+    elif use_async_client: run_with_async_query()
     else: run_with_query()
 
     # Post processing
     # Recursively populate full paths. todo: This could be moved to "should_write_output"
-    all_folders.populate_all_paths()
+    # For the bounded memory folder csv, paths are not kept (they are rebuilt when written)
+    all_folders.populate_all_paths(memoise=not folder_csv_external_sort)
 
     if intense_debug:
         print_set("All files", all_file_set)
@@ -692,6 +968,8 @@ def main():
         pickle_file = open("pickleoutput.db", "wb")
         pickle.dump(all_folders, pickle_file)
         pickle.dump(tracked_files, pickle_file)
+        pickle.dump(principal_index, pickle_file)
+        pickle.dump(permission_sets, pickle_file)
         pickle_file.close()
 
         with open("csv_tracked_files.csv", "w") as csv_file:
@@ -701,36 +979,35 @@ def main():
             writer = csv.DictWriter(csv_file, csv_columns)
             writer.writeheader()
             for file in tracked_files.values():
-                writer.writerow(file.tracked_file_csv_info())
+                writer.writerow(file.tracked_file_csv_info(memoise_path=not folder_csv_external_sort))
 
         # For writing details of folders
-        folders_list: List[Folder] = list(all_folders.data.values())
-        for f in folders_list:
-            # Recursively go down the tree from each folder
-            # to populate depth, total size, and total children count
-            f.traverse_all_children()
-
-        folders_list.sort(key=lambda x: x.full_path)
-
-        with open("csv_folder_info.csv", "w") as csv_file:
-            csv_columns = [
-                'folder_name', 'id', 'url', 'fullpath', 'num_children', 'total_size', 'owners'
-            ]
-            writer = csv.DictWriter(csv_file, csv_columns)
-            writer.writeheader()
-            for folder in folders_list:
-                # todo: consider only counting certain folders
-                # todo: move this logic into folder (or move the trackedfile logic off trackedFile)
-                row = {
-                    'folder_name': folder.name,
-                    'id': folder.id,
-                    'url': folder.url,
-                    'fullpath': folder.full_path,
-                    'num_children': folder.all_children_count,
-                    'total_size': folder.size_all_children,
-                    'owners': folder.owners
-                }
-                writer.writerow(row)
+        # Todo: these must be kept the same as folder_csv_info()
+        csv_columns = [
+            'folder_name', 'id', 'url', 'fullpath', 'num_children', 'total_size', 'owners'
+        ]
+        if folder_csv_gzip:
+            csv_file = gzip.open("csv_folder_info.csv.gz", "wt", newline="")
+        else:
+            csv_file = open("csv_folder_info.csv", "w")
+
+        with csv_file:
+            if folder_csv_external_sort:
+                write_folder_csv_external_sort(csv_file, csv_columns)
+            else:
+                folders_list: List[Folder] = list(all_folders.data.values())
+                for f in folders_list:
+                    # Recursively go down the tree from each folder
+                    # to populate depth, total size, and total children count
+                    f.traverse_all_children()
+
+                folders_list.sort(key=lambda x: x.full_path)
+
+                writer = csv.DictWriter(csv_file, csv_columns)
+                writer.writeheader()
+                for folder in folders_list:
+                    # todo: consider only counting certain folders
+                    writer.writerow(folder.folder_csv_info())
 
 
 if __name__ == "__main__":
@@ -749,14 +1026,24 @@ if __name__ == "__main__":
     max_results_api_setting = config['max_results_api_setting']
     max_metadata_fetch_try_count = config['max_metadata_fetch_try_count']  # Generally fetch never fails
     log_file_if_size_greater_than_limit = float(config['log_file_if_size_greater_than_limit']) # (100 MB)
+    async_max_in_flight_requests = config['async_max_in_flight_requests']
+    folder_csv_external_sort = config['folder_csv_external_sort']
+    folder_csv_memory_budget_mb = float(config['folder_csv_memory_budget_mb'])
+    folder_csv_gzip = config['folder_csv_gzip']
 
     # DATA ACCUMULATION
     # Accumulates all folders during run. Also generates tracked files
-    all_folders: FolderTracker = FolderTracker()
+    all_folders: FolderTracker = FolderTracker(orphan_prefix, name_for_non_seeable_folders)
 
     # Accumulates files of interest during run Populated in FolderTracker.log_item()
     tracked_files: Dict[str, TrackedFile] = dict()
 
+    # Principal => files it can access. Populated in TrackedFile.process_sharing_metadata()
+    principal_index: PrincipalAccessIndex = PrincipalAccessIndex()
+
+    # Distinct permission sets, shared by TrackedFiles. Populated in TrackedFile.process_sharing_metadata()
+    permission_sets: PermissionSetRegistry = PermissionSetRegistry()
+
     # Only for intense debugging; not generally used
     all_file_set: List[GoogleDriveFileList] = []
 
@@ -18,8 +18,9 @@ if __name__ == "__main__":
     pf = open(sys.argv[1], "rb")
     # pf = open("./pickleoutput.db")
     all_folders: FolderTracker = pickle.load(pf)
+    all_folders.restore_path_settings()
     folder_list = list(all_folders.data.values())
     for f in folder_list:
-        f.all_children_count()
+        _ = f.all_children_count
 
     print_folders(folder_list)
\ No newline at end of file
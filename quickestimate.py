@@ -0,0 +1,309 @@
+from __future__ import annotations
+import asyncio
+import math
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+import yaml
+
+from pydrive.auth import GoogleAuth
+
+from asyncdrive import AsyncDriveClient, pydrive_token_provider
+from googdrivecheck import SafeFile
+
+''' Brief readme Note:
+    Quick estimate of a drive, without a full googdrivecheck.py run. Used to triage large drives.
+    1) The drive's modified dates (oldest file -> now) are cut into estimate_num_slices time slices
+    2) A random estimate_sample_fraction of the slices is listed completely (with only the fields we need)
+    3) From the sampled shared files owned by the user, estimate_permission_sample_size files are picked at random
+        and their permissions fetched, to estimate how many have link sharing
+    4) The parent folders of the sampled files are fetched (only id / title / parents), level by level up the
+        tree, so every sampled file maps to its top level folder
+    5) Totals are extrapolated from the sampled slices (cluster sampling) with 95% confidence intervals
+
+    Listing, folder and permission calls all grow with the sample, not the drive, so a run takes roughly
+    estimate_sample_fraction of a full run's time.
+'''
+
+z_95 = 1.96     # 95% confidence intervals
+
+slice_list_fields = "nextPageToken,items(id,fileSize,shared,ownerNames,parents(id),mimeType)"
+folder_fields = "id,title,parents(id)"
+no_folder_name = "(no folder)"  # Bucket for files directly in a root dir, or without a visible parent
+
+
+class Estimate(NamedTuple):
+    value: float
+    low: float
+    high: float
+
+    def __str__(self):
+        return "%.4g (95%% CI %.4g - %.4g)" % (self.value, self.low, self.high)
+
+
+class SliceSample:
+    """ Totals for one completely listed time slice """
+    def __init__(self):
+        self.file_count = 0
+        self.total_bytes = 0
+        self.shared_count = 0
+        self.shared_owned_ids: List[str] = []      # Shared files owned by us (candidates for permission sampling)
+        # Folder id (the file's parent, or its own id for a folder) => bytes. Mapped to top level folders later
+        self.bytes_by_folder: Dict[Optional[str], int] = dict()
+
+    def bytes_by_top_folder(self, top_folders: TopFolderLookup) -> Dict[Optional[str], int]:
+        """ Top level folder id (None for no folder) => bytes """
+        result: Dict[Optional[str], int] = dict()
+        for folder_id, size in self.bytes_by_folder.items():
+            top_folder_id = top_folders.top_folder_id(folder_id)
+            result[top_folder_id] = result.get(top_folder_id, 0) + size
+        return result
+
+
+def _sample_variance(values: List[float]) -> float:
+    mean = sum(values) / len(values)
+    return sum((x - mean) ** 2 for x in values) / (len(values) - 1)
+
+
+def estimate_total(values: List[float], num_slices: int) -> Estimate:
+    """ Total over all num_slices slices, from the totals of a simple random sample of slices """
+    k = len(values)
+    total = num_slices / k * sum(values)
+    variance = num_slices ** 2 * (1 - k / num_slices) * _sample_variance(values) / k
+    margin = z_95 * math.sqrt(variance)
+    return Estimate(total, max(total - margin, 0), total + margin)
+
+
+def estimate_ratio(numerators: List[float], denominators: List[float], num_slices: int) -> Estimate:
+    """ Ratio of two totals (e.g. shared files / all files), with a linearised (delta method) variance """
+    k = len(numerators)
+    if sum(denominators) == 0:
+        return Estimate(0, 0, 0)
+    ratio = sum(numerators) / sum(denominators)
+    mean_denominator = sum(denominators) / k
+    residuals = [y - ratio * x for y, x in zip(numerators, denominators)]
+    variance = (1 - k / num_slices) * _sample_variance(residuals) / (k * mean_denominator ** 2)
+    margin = z_95 * math.sqrt(variance)
+    return Estimate(ratio, max(ratio - margin, 0), min(ratio + margin, 1))
+
+
+def estimate_product(total: Estimate, proportion: float, proportion_sample_size: int,
+                     proportion_population_size: int) -> Estimate:
+    """ total * proportion, where proportion was measured on a random subset of the sampled files """
+    value = total.value * proportion
+    total_variance = ((total.high - total.value) / z_95) ** 2
+    if proportion_sample_size > 0:
+        fpc = 1 - proportion_sample_size / max(proportion_population_size, 1)
+        proportion_variance = proportion * (1 - proportion) / proportion_sample_size * fpc
+    else:
+        proportion_variance = 0
+    variance = proportion ** 2 * total_variance + total.value ** 2 * proportion_variance
+    margin = z_95 * math.sqrt(variance)
+    return Estimate(value, max(value - margin, 0), value + margin)
+
+
+def _format_drive_date(date: datetime) -> str:
+    return date.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def _parse_drive_date(date_string: str) -> datetime:
+    return datetime.strptime(date_string[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+class TopFolderLookup:
+    """ Maps folder ids to the id of their top level folder. Only the ancestors of sampled files are fetched """
+    def __init__(self):
+        self.titles: Dict[str, str] = dict()
+        self.parent_ids: Dict[str, Optional[str]] = dict()
+        self._cache: Dict[str, str] = dict()
+
+    async def _fetch_folder(self, client: AsyncDriveClient, folder_id: str) -> Optional[dict]:
+        try:
+            return await client.get_metadata(folder_id, fields=folder_fields)
+        except Exception as e:
+            # Typically a parent we have no access to. Its child becomes the top level folder
+            print("could not fetch folder id: %s (%s)" % (folder_id, str(e)))
+            return None
+
+    async def resolve(self, client: AsyncDriveClient, folder_ids: Iterable[Optional[str]]) -> int:
+        """ Fetches folder_ids and all their ancestors, one tree level at a time. Returns the number fetched """
+        fetched: Set[str] = set()
+        to_fetch = set(x for x in folder_ids if x is not None)
+        while len(to_fetch) > 0:
+            fetch_ids = list(to_fetch)
+            fetched.update(fetch_ids)
+            # The client bounds how many of these are in flight at once
+            folders = await asyncio.gather(*[self._fetch_folder(client, x) for x in fetch_ids])
+
+            to_fetch = set()
+            for folder_id, folder in zip(fetch_ids, folders):
+                if folder is None:
+                    continue
+                title = SafeFile.safe_get(folder, 'name')
+                parents = SafeFile.safe_get(folder, '_safe_parents', issue_warning_if_not_present=False) or []
+                parent_id = parents[0]['id'] if len(parents) > 0 else None
+                if parent_id is None and title in rootdirs:
+                    continue    # Root dirs (e.g. My Drive) are not top level folders; their children are
+                self.titles[folder_id] = title
+                self.parent_ids[folder_id] = parent_id
+                if parent_id is not None and parent_id not in fetched:
+                    to_fetch.add(parent_id)
+        return len(fetched)
+
+    def top_folder_id(self, folder_id: Optional[str]) -> Optional[str]:
+        # The top level folder is the highest ancestor that is not a root dir (or not visible)
+        if folder_id is None or folder_id not in self.titles:
+            return None
+        if folder_id in self._cache:
+            return self._cache[folder_id]
+
+        visited = [folder_id]
+        current_id = folder_id
+        while self.parent_ids[current_id] in self.titles and self.parent_ids[current_id] not in visited:
+            current_id = self.parent_ids[current_id]
+            visited.append(current_id)
+        for x in visited:
+            self._cache[x] = current_id
+        return current_id
+
+    def title(self, top_folder_id: Optional[str]) -> str:
+        return no_folder_name if top_folder_id is None else self.titles[top_folder_id]
+
+
+async def _list_all(client: AsyncDriveClient, query: dict) -> List[dict]:
+    items = []
+    async for file_list in client.iter_file_pages(query):
+        items.extend(file_list)
+    return items
+
+
+async def _sample_slice(client: AsyncDriveClient, start: datetime, end: datetime) -> SliceSample:
+    q_string = "trashed=false and modifiedDate > '%s' and modifiedDate <= '%s'" % \
+               (_format_drive_date(start), _format_drive_date(end))
+    query = {'maxResults': max_results_api_setting, 'q': q_string, 'fields': slice_list_fields}
+
+    sample = SliceSample()
+    async for file_list in client.iter_file_pages(query):
+        for file in file_list:
+            file_size = int(SafeFile.file_size(file))
+            sample.file_count += 1
+            sample.total_bytes += file_size
+            if SafeFile.safe_get(file, 'shared'):
+                sample.shared_count += 1
+                if my_user_name in SafeFile.safe_get(file, 'ownerNames'):
+                    sample.shared_owned_ids.append(SafeFile.safe_get(file, 'id'))
+
+            parents = SafeFile.safe_get(file, '_safe_parents', issue_warning_if_not_present=False) or []
+            parent_id = parents[0]['id'] if len(parents) > 0 else None
+            # A top level folder is counted in its own bucket
+            folder_id = SafeFile.safe_get(file, 'id') if SafeFile.is_folder(file) else parent_id
+            sample.bytes_by_folder[folder_id] = sample.bytes_by_folder.get(folder_id, 0) + file_size
+    return sample
+
+
+async def _has_link_sharing(client: AsyncDriveClient, file_id: str) -> Optional[bool]:
+    try:
+        permissions = await client.list_permissions(file_id)
+    except Exception as e:
+        print("error fetching permissions for id: %s. Skipping" % file_id)
+        print(str(e))
+        return None
+    return any(perm['type'] == "anyone" for perm in permissions)
+
+
+async def run_estimate(client: AsyncDriveClient):
+    start_time = time.time()
+
+    # Fields exclude nextPageToken, so this is a single request
+    oldest_query = {'maxResults': 1, 'q': "trashed=false", 'orderBy': "modifiedDate", 'fields': "items(modifiedDate)"}
+    oldest = await _list_all(client, oldest_query)
+    if len(oldest) == 0:
+        print("No files found")
+        return
+    range_start = _parse_drive_date(oldest[0]['modifiedDate']) - timedelta(seconds=1)
+    range_end = datetime.utcnow() + timedelta(days=1)
+    slice_length = (range_end - range_start) / estimate_num_slices
+
+    num_sampled = min(max(2, round(estimate_num_slices * estimate_sample_fraction)), estimate_num_slices)
+    sampled_slice_indices = sorted(random.sample(range(estimate_num_slices), num_sampled))
+    print("Sampling %d of %d time slices between %s and %s" %
+          (num_sampled, estimate_num_slices, _format_drive_date(range_start), _format_drive_date(range_end)))
+
+    samples: List[SliceSample] = await asyncio.gather(*[
+        _sample_slice(client, range_start + i * slice_length, range_start + (i + 1) * slice_length)
+        for i in sampled_slice_indices])
+    print("Listed %d files in sampled slices" % sum(x.file_count for x in samples))
+
+    top_folders = TopFolderLookup()
+    num_folders_fetched = await top_folders.resolve(client, set(folder_id for x in samples
+                                                                for folder_id in x.bytes_by_folder))
+    print("Fetched %d folders (parents of sampled files and their ancestors)" % num_folders_fetched)
+
+    shared_owned_ids = [file_id for x in samples for file_id in x.shared_owned_ids]
+    permission_sample_ids = random.sample(shared_owned_ids, min(estimate_permission_sample_size,
+                                                                len(shared_owned_ids)))
+    link_sharing_results = [x for x in await asyncio.gather(*[_has_link_sharing(client, file_id)
+                                                              for file_id in permission_sample_ids])
+                            if x is not None]
+    link_sharing_proportion = sum(link_sharing_results) / len(link_sharing_results) \
+        if len(link_sharing_results) > 0 else 0
+
+    # Extrapolate
+    file_counts = [x.file_count for x in samples]
+    total_files = estimate_total(file_counts, estimate_num_slices)
+    total_bytes = estimate_total([x.total_bytes for x in samples], estimate_num_slices)
+    shared_ratio = estimate_ratio([x.shared_count for x in samples], file_counts, estimate_num_slices)
+    total_shared = estimate_total([x.shared_count for x in samples], estimate_num_slices)
+    total_shared_owned = estimate_total([len(x.shared_owned_ids) for x in samples], estimate_num_slices)
+    link_sharing = estimate_product(total_shared_owned, link_sharing_proportion,
+                                    len(link_sharing_results), len(shared_owned_ids))
+
+    print("\n** Quick estimate (%.0f seconds)" % (time.time() - start_time))
+    print("Files:\t\t\t\t%s" % str(total_files))
+    print("Total size (bytes):\t\t%s" % str(total_bytes))
+    print("Shared files:\t\t\t%s" % str(total_shared))
+    print("Share ratio:\t\t\t%s" % str(shared_ratio))
+    print("Shared files owned by me:\t%s" % str(total_shared_owned))
+    print("... with link sharing:\t\t%s\t(permissions fetched for %d files)" %
+          (str(link_sharing), len(link_sharing_results)))
+
+    # Keyed by folder id, so that top level folders with the same title are estimated separately
+    sample_bytes_by_top_folder = [x.bytes_by_top_folder(top_folders) for x in samples]
+    all_top_folder_ids = set(folder_id for x in sample_bytes_by_top_folder for folder_id in x)
+    top_folder_sizes = [(folder_id, estimate_total([x.get(folder_id, 0) for x in sample_bytes_by_top_folder],
+                                                   estimate_num_slices))
+                        for folder_id in all_top_folder_ids]
+    top_folder_sizes.sort(key=lambda x: x[1].value, reverse=True)
+    print("\n** Largest top level folders (bytes)")
+    for folder_id, size in top_folder_sizes[:estimate_num_top_folders]:
+        print("%s\t%s\t%s" % (top_folders.title(folder_id), folder_id or "", str(size)))
+
+
+if __name__ == "__main__":
+    # Auth login (see also settings.yaml)
+    gauth = GoogleAuth()
+    gauth.LocalWebserverAuth()
+
+    config = yaml.safe_load(open('settings.yaml'))
+    my_user_name = config['my_user_name']
+    rootdirs = config['rootdirs']
+    max_results_api_setting = config['max_results_api_setting']
+    max_metadata_fetch_try_count = config['max_metadata_fetch_try_count']
+    async_max_in_flight_requests = config['async_max_in_flight_requests']
+    estimate_num_slices = config['estimate_num_slices']
+    estimate_sample_fraction = float(config['estimate_sample_fraction'])
+    # At least two slices must be sampled to estimate a variance (so at least two slices overall)
+    if estimate_num_slices < 2:
+        raise Exception("estimate_num_slices must be at least 2 (got %s)" % estimate_num_slices)
+    if not 0 < estimate_sample_fraction <= 1:
+        raise Exception("estimate_sample_fraction must be in (0, 1] (got %s)" % estimate_sample_fraction)
+    estimate_permission_sample_size = config['estimate_permission_sample_size']
+    estimate_num_top_folders = config['estimate_num_top_folders']
+
+    async def _main():
+        async with AsyncDriveClient(pydrive_token_provider(gauth), max_in_flight=async_max_in_flight_requests,
+                                    max_try_count=max_metadata_fetch_try_count) as client:
+            await run_estimate(client)
+
+    asyncio.run(_main())
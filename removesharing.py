@@ -0,0 +1,222 @@
+import csv
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, NamedTuple, Set, Tuple
+import yaml
+
+from googleapiclient.errors import HttpError
+from pydrive.auth import GoogleAuth
+
+from asyncdrive import is_retryable_error
+
+# Every class in pickleoutput.db must be imported here (googdrivecheck.py pickles them as __main__.<Class>)
+from googdrivecheck import CanonicalPermission, Folder, FolderTracker, PermissionSet, PermissionSetRegistry, \
+    PrincipalAccess, PrincipalAccessIndex, SafeFile, TrackedFile
+
+''' Brief readme Note:
+    Removes sharing from tracked files for any user / group / domain not in sharing_allow_list (settings.yaml).
+    Run googdrivecheck.py first; this reads the tracked files from its pickle output.
+    1) plan_removals() walks the tracked files and lists every permission to delete
+    2) The plan is always written to csv_sharing_removal_plan.csv. With remediation_dry_run we stop here
+    3) Otherwise the plan is split into batches (one Drive batch request each), and up to
+        remediation_max_concurrent_batches batches run at once
+    4) Every finished deletion is appended to the journal, so an interrupted run can simply be rerun:
+        anything already in the journal is skipped
+
+    Deleting permissions needs the full https://www.googleapis.com/auth/drive oauth_scope
+'''
+
+# Journal statuses for which we never need to retry the deletion
+journal_done_statuses = ["removed", "not_found"]
+
+
+class PlannedRemoval(NamedTuple):
+    file_id: str
+    file_name: str
+    fullpath: str
+    permission_id: str
+    permission_type: str
+    principal: str
+
+
+def is_allowed(principal: str, allow_list: Set[str]) -> bool:
+    """ Whether principal may keep access. Domains in allow_list also allow every address in that domain """
+    principal = principal.lower()
+    if principal in allow_list:
+        return True
+    if "@" in principal and principal.split("@", 1)[1] in allow_list:
+        return True
+    return False
+
+
+def plan_removals(tracked_files: Dict[str, TrackedFile], permission_sets: PermissionSetRegistry,
+                  allow_list: Set[str]) -> List[PlannedRemoval]:
+    """
+    Lists the permissions to delete. Only files whose sharing metadata was fetched (shared files we own)
+    have a permission set; everything else is skipped. Sorted so that the same inputs always give the same plan.
+
+    :param tracked_files: id => TrackedFile, as pickled by googdrivecheck.py
+    :param permission_sets: the PermissionSetRegistry pickled with tracked_files
+    :param allow_list: lowercased emails, domains and optionally "anyone"
+    """
+    # Permissions to remove, worked out once per distinct permission set
+    # (owner permissions cannot be deleted; ownership must be transferred instead)
+    removable_by_set_id: Dict[int, List[CanonicalPermission]] = dict()
+
+    plan = []
+    for tracked_file in tracked_files.values():
+        set_id = tracked_file.permission_set_id
+        if set_id is None:
+            continue
+        if set_id not in removable_by_set_id:
+            removable_by_set_id[set_id] = [perm for perm in permission_sets.get(set_id).permissions
+                                           if perm.role != "owner" and not is_allowed(perm.principal, allow_list)]
+
+        file = tracked_file.file
+        for perm in removable_by_set_id[set_id]:
+            plan.append(PlannedRemoval(
+                file_id=SafeFile.safe_get(file, 'id'),
+                file_name=SafeFile.safe_get(file, 'name'),
+                fullpath=SafeFile.get_full_path(file, tracked_file.parent_folder),
+                permission_id=perm.id,
+                permission_type=perm.type,
+                principal=perm.principal))
+
+    plan.sort(key=lambda x: (x.fullpath, x.file_id, x.permission_id))
+    return plan
+
+
+def write_plan(plan: List[PlannedRemoval], plan_file_name: str):
+    with open(plan_file_name, "w") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(PlannedRemoval._fields)
+        for removal in plan:
+            writer.writerow(removal)
+
+
+def load_journal(journal_file_name: str) -> Set[Tuple[str, str]]:
+    """ Returns the (file_id, permission_id) pairs that an earlier run already finished """
+    done = set()
+    if not os.path.exists(journal_file_name):
+        return done
+    with open(journal_file_name, "r") as journal_file:
+        for row in csv.reader(journal_file):
+            if len(row) >= 3 and row[2] in journal_done_statuses:
+                done.add((row[0], row[1]))
+    return done
+
+
+def _run_batch(gauth: GoogleAuth, batch_removals: List[PlannedRemoval]) -> List[Tuple[PlannedRemoval, str, str]]:
+    """
+    Executes one Drive batch request of permission deletions, retrying the requests that were rate limited.
+    Runs in a worker thread, so it uses its own http object (httplib2 is not thread safe).
+
+    :return: (removal, status, detail) for every removal in the batch
+    """
+    http = gauth.Get_Http_Object()
+    results = []
+    pending = list(range(len(batch_removals)))
+    try_count = 0
+    while len(pending) > 0:
+        responses: Dict[str, Exception] = {}
+
+        def callback(request_id, _response, exception):
+            responses[request_id] = exception
+
+        batch = gauth.service.new_batch_http_request(callback=callback)
+        for i in pending:
+            removal = batch_removals[i]
+            batch.add(gauth.service.permissions().delete(fileId=removal.file_id,
+                                                         permissionId=removal.permission_id),
+                      request_id=str(i))
+        try:
+            batch.execute(http=http)
+        except Exception as e:
+            # The whole batch failed; treat every request in it as retryable
+            responses = {str(i): e for i in pending}
+
+        retry = []
+        for i in pending:
+            exception = responses.get(str(i))
+            if exception is None:
+                results.append((batch_removals[i], "removed", ""))
+            elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                results.append((batch_removals[i], "not_found", ""))
+            elif (not isinstance(exception, HttpError) or
+                  is_retryable_error(exception.resp.status, exception.content.decode("utf-8", "replace"))) and \
+                    try_count + 1 < max_metadata_fetch_try_count:
+                retry.append(i)
+            else:
+                results.append((batch_removals[i], "failed", str(exception)))
+
+        pending = retry
+        try_count += 1
+        if len(pending) > 0:
+            time.sleep(2 ** try_count)   # Back off before retrying rate limited requests
+
+    return results
+
+
+def execute_plan(gauth: GoogleAuth, plan: List[PlannedRemoval], journal_file_name: str,
+                 batch_size: int, max_concurrent_batches: int):
+    """
+    Deletes all permissions in the plan that are not already in the journal. Results are journaled
+    (in the main thread) as each batch finishes.
+    """
+    done = load_journal(journal_file_name)
+    todo = [x for x in plan if (x.file_id, x.permission_id) not in done]
+    print("%d permissions planned, %d already done in journal, %d to remove" %
+          (len(plan), len(plan) - len(todo), len(todo)))
+
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    status_counts: Dict[str, int] = dict()
+    with open(journal_file_name, "a") as journal_file, \
+            ThreadPoolExecutor(max_workers=max_concurrent_batches) as executor:
+        journal = csv.writer(journal_file)
+        futures = [executor.submit(_run_batch, gauth, batch) for batch in batches]
+        for future in as_completed(futures):
+            for removal, status, detail in future.result():
+                journal.writerow([removal.file_id, removal.permission_id, status, detail])
+                status_counts[status] = status_counts.get(status, 0) + 1
+                if status == "failed":
+                    print("failed to remove %s from %s: %s" % (removal.principal, removal.fullpath, detail))
+            journal_file.flush()
+            print("Processed %d permissions" % sum(status_counts.values()))
+
+    print("Done. " + ", ".join("%s: %d" % (k, v) for k, v in status_counts.items()))
+
+
+if __name__ == "__main__":
+    config = yaml.safe_load(open('settings.yaml'))
+    sharing_allow_list = set(x.lower() for x in config['sharing_allow_list'])
+    remediation_dry_run = config['remediation_dry_run']
+    remediation_batch_size = min(config['remediation_batch_size'], 100)   # Drive allows 100 calls per batch
+    remediation_max_concurrent_batches = config['remediation_max_concurrent_batches']
+    remediation_journal_file = config['remediation_journal_file']
+    max_metadata_fetch_try_count = config['max_metadata_fetch_try_count']
+
+    pf = open(sys.argv[1] if len(sys.argv) > 1 else "pickleoutput.db", "rb")
+    all_folders: FolderTracker = pickle.load(pf)     # written first by googdrivecheck.py
+    all_folders.restore_path_settings()     # plan_removals() builds full paths
+    tracked_files: Dict[str, TrackedFile] = pickle.load(pf)
+    _ = pickle.load(pf)     # principal_index
+    permission_sets: PermissionSetRegistry = pickle.load(pf)
+    pf.close()
+
+    removal_plan = plan_removals(tracked_files, permission_sets, sharing_allow_list)
+    write_plan(removal_plan, "csv_sharing_removal_plan.csv")
+    print("Wrote %d planned permission removals to csv_sharing_removal_plan.csv" % len(removal_plan))
+
+    if remediation_dry_run:
+        print("Dry run; no sharing was removed. Set remediation_dry_run to False in settings.yaml to remove it")
+    else:
+        gauth = GoogleAuth()
+        gauth.LocalWebserverAuth()
+        # LocalWebserverAuth only builds gauth.service when it has to log in; saved credentials skip that
+        if gauth.service is None:
+            gauth.Authorize()
+        execute_plan(gauth, removal_plan, remediation_journal_file,
+                     remediation_batch_size, remediation_max_concurrent_batches)
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import unittest
+from functools import partial
+from types import SimpleNamespace
+from typing import Optional
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import googdrivecheck
+from asyncdrive import AsyncDriveClient
+
+''' Tests for asyncdrive.py (and googdrivecheck._async_query), against a local stand-in for the Drive v2 API.
+    Run with: python3 -m pytest test_asyncdrive.py   (or python3 -m unittest test_asyncdrive)
+'''
+
+
+def drive_file(file_id: str, parent_id: Optional[str], title: str, is_folder=False, shared=False) -> dict:
+    """ A files.list item with the fields that SafeFile reads """
+    return {'id': file_id, 'title': title, 'shared': shared,
+            'mimeType': "application/vnd.google-apps.folder" if is_folder else "text/plain",
+            'owners': [{'displayName': "me"}], 'ownerNames': ["me"], 'alternateLink': "https://drive/" + file_id,
+            'parents': [{'id': parent_id}] if parent_id is not None else [], 'spaces': ["drive"],
+            'labels': {'trashed': False}, 'fileSize': "10"}
+
+
+def error_body(code: int, reason: str) -> str:
+    return json.dumps({'error': {'code': code, 'message': reason, 'errors': [{'reason': reason}]}})
+
+
+class DriveStandIn:
+    """
+    Serves files.list (page_size files per page), permissions.list and permissions.delete.
+    Add (status, body) pairs to failures[path] to fail the next requests for that path
+    """
+    def __init__(self, files, permissions=None, page_size=2):
+        self.files = files
+        self.permissions = permissions or dict()
+        self.page_size = page_size
+        self.failures = dict()
+        self.requests = []      # (method, path, pageToken) in arrival order
+        self.page_requested = dict()    # pageToken => set once that page was requested
+
+        app = web.Application()
+        app.router.add_get("/files", self.list_files)
+        app.router.add_get("/files/{file_id}/permissions", self.list_permissions)
+        app.router.add_delete("/files/{file_id}/permissions/{permission_id}", self.delete_permission)
+        self.server = TestServer(app)
+
+    def url(self) -> str:
+        return str(self.server.make_url(""))
+
+    def page_requested_event(self, page_token: Optional[str]) -> asyncio.Event:
+        return self.page_requested.setdefault(page_token, asyncio.Event())
+
+    def _record_or_fail(self, request: web.Request) -> Optional[web.Response]:
+        page_token = request.query.get('pageToken')
+        self.requests.append((request.method, request.path, page_token))
+        self.page_requested_event(page_token).set()
+        failures = self.failures.get(request.path)
+        if failures:
+            status, body = failures.pop(0)
+            return web.Response(status=status, text=body)
+        return None
+
+    async def list_files(self, request: web.Request) -> web.Response:
+        failure = self._record_or_fail(request)
+        if failure is not None:
+            return failure
+        start = int(request.query.get('pageToken', 0))
+        response = {'items': self.files[start:start + self.page_size]}
+        if start + self.page_size < len(self.files):
+            response['nextPageToken'] = str(start + self.page_size)
+        return web.json_response(response)
+
+    async def list_permissions(self, request: web.Request) -> web.Response:
+        failure = self._record_or_fail(request)
+        if failure is not None:
+            return failure
+        return web.json_response({'items': self.permissions.get(request.match_info['file_id'], [])})
+
+    async def delete_permission(self, request: web.Request) -> web.Response:
+        failure = self._record_or_fail(request)
+        if failure is not None:
+            return failure
+        return web.Response(status=204)
+
+
+class AsyncDriveClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        files = [drive_file("f%d" % i, None, "file%d" % i) for i in range(5)]
+        self.drive = DriveStandIn(files)
+        await self.drive.server.start_server()
+
+    async def asyncTearDown(self):
+        await self.drive.server.close()
+
+    def client(self, max_try_count=3) -> AsyncDriveClient:
+        return AsyncDriveClient(lambda: "token", base_url=self.drive.url(), max_try_count=max_try_count,
+                                backoff_seconds=0)
+
+    async def test_pages_are_listed_in_order(self):
+        async with self.client() as client:
+            pages = [page async for page in client.iter_file_pages({'maxResults': 2})]
+        self.assertEqual([[x['id'] for x in page] for page in pages], [["f0", "f1"], ["f2", "f3"], ["f4"]])
+        self.assertEqual([x[2] for x in self.drive.requests], [None, "2", "4"])
+
+    async def test_next_page_is_requested_before_the_current_one_is_used(self):
+        async with self.client() as client:
+            async for page in client.iter_file_pages({'maxResults': 2}):
+                if page[0]['id'] == "f0":
+                    # Would time out if the second page were only requested once we ask for it
+                    await asyncio.wait_for(self.drive.page_requested_event("2").wait(), 5)
+
+    async def test_server_errors_are_retried(self):
+        self.drive.failures["/files"] = [(500, "oops"), (503, "oops")]
+        async with self.client() as client:
+            pages = [page async for page in client.iter_file_pages({'maxResults': 2})]
+        self.assertEqual(sum(len(page) for page in pages), 5)
+        self.assertEqual([x[2] for x in self.drive.requests], [None, None, None, "2", "4"])
+
+    async def test_gives_up_after_max_try_count(self):
+        self.drive.failures["/files/f0/permissions"] = [(500, "oops")] * 3
+        async with self.client(max_try_count=3) as client:
+            with self.assertRaises(Exception):
+                await client.list_permissions("f0")
+        self.assertEqual(len(self.drive.requests), 3)
+
+    async def test_only_rate_limit_403s_are_retried(self):
+        self.drive.failures["/files/f0/permissions"] = [(403, error_body(403, "userRateLimitExceeded"))]
+        self.drive.failures["/files/f1/permissions"] = [(403, error_body(403, "insufficientFilePermissions"))]
+        async with self.client() as client:
+            self.assertEqual(await client.list_permissions("f0"), [])
+            with self.assertRaises(Exception):
+                await client.list_permissions("f1")
+        self.assertEqual([x[1] for x in self.drive.requests],
+                         ["/files/f0/permissions", "/files/f0/permissions", "/files/f1/permissions"])
+
+    async def test_delete_returns_no_content(self):
+        async with self.client() as client:
+            self.assertIsNone(await client.delete_permission("f0", "p1"))
+        self.assertEqual(self.drive.requests, [("DELETE", "/files/f0/permissions/p1", None)])
+
+
+class AsyncQueryTest(unittest.IsolatedAsyncioTestCase):
+    """ googdrivecheck._async_query, from listing through to the interned permission sets and the principal index """
+    async def asyncSetUp(self):
+        files = [drive_file("root", None, "My Drive", is_folder=True),
+                 drive_file("docs", "root", "docs", is_folder=True),
+                 drive_file("a", "docs", "a.txt", shared=True),
+                 drive_file("b", "docs", "b.txt", shared=True),
+                 drive_file("c", "docs", "c.txt", shared=True),
+                 drive_file("d", "docs", "d.txt")]
+        owner = {'id': "p0", 'type': "user", 'role': "owner", 'emailAddress': "me@home.com"}
+        partner = {'id': "p1", 'type': "user", 'role': "reader", 'emailAddress': "Bob@Partner.com"}
+        link = {'id': "anyoneWithLink", 'type': "anyone", 'role': "reader"}
+        self.drive = DriveStandIn(files, {'a': [owner, partner], 'b': [partner, owner], 'c': [owner, link]})
+        self.drive.failures["/files/b/permissions"] = [(502, "bad gateway")]
+        await self.drive.server.start_server()
+
+        self.all_folders = googdrivecheck.FolderTracker("0_orphan", "no_name")
+        self.tracked_files = dict()
+        self.principal_index = googdrivecheck.PrincipalAccessIndex()
+        self.permission_sets = googdrivecheck.PermissionSetRegistry()
+        # The globals that googdrivecheck.py's __main__ sets up
+        self.globals = mock.patch.multiple(
+            googdrivecheck, create=True,
+            AsyncDriveClient=partial(AsyncDriveClient, base_url=self.drive.url(), backoff_seconds=0),
+            gauth=SimpleNamespace(access_token_expired=False, credentials=SimpleNamespace(access_token="token")),
+            my_user_name="me", rootdirs=["My Drive"], orphan_prefix="0_orphan", name_for_non_seeable_folders="no_name",
+            log_file_if_size_greater_than_limit=1e9, max_metadata_fetch_try_count=3, async_max_in_flight_requests=4,
+            all_folders=self.all_folders, tracked_files=self.tracked_files, principal_index=self.principal_index,
+            permission_sets=self.permission_sets, all_file_set=[])
+        self.globals.start()
+
+    async def asyncTearDown(self):
+        self.globals.stop()
+        await self.drive.server.close()
+
+    async def test_sharing_metadata_is_interned_and_indexed(self):
+        await googdrivecheck._async_query({'maxResults': 2, 'q': "trashed=false"})
+
+        self.assertEqual(sorted(self.tracked_files), ["a", "b", "c"])
+        # Same permissions in a different order share one PermissionSet
+        set_ids = {x: self.tracked_files[x].permission_set_id for x in "abc"}
+        self.assertEqual(set_ids['a'], set_ids['b'])
+        self.assertNotEqual(set_ids['a'], set_ids['c'])
+        self.assertEqual(len(self.permission_sets.sets), 2)
+        self.assertTrue(self.permission_sets.get(set_ids['c']).has_link_sharing)
+        self.assertTrue(self.tracked_files['c'].props['has_link_sharing'])
+        # Permissions are dropped from the file once interned
+        self.assertNotIn('permissions', self.tracked_files['a'].file)
+
+        self.assertEqual(self.principal_index.lookup("bob@partner.com").file_ids, {"a", "b"})
+        self.assertEqual(self.principal_index.lookup("anyone").file_ids, {"c"})
+        self.assertEqual([x.principal for x in self.principal_index.lookup_domain("home.com")], ["me@home.com"])
+        self.assertEqual(self.all_folders.static_folder_lookup("docs").full_path, "My Drive/docs")
+
+
+if __name__ == "__main__":
+    unittest.main()
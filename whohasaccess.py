@@ -0,0 +1,46 @@
+import pickle
+import sys
+
+# Every class in pickleoutput.db must be imported here (googdrivecheck.py pickles them as __main__.<Class>)
+from googdrivecheck import Folder, FolderTracker, PrincipalAccess, PrincipalAccessIndex, SafeFile, TrackedFile
+from typing import Dict, List
+
+''' Usage: python3 whohasaccess.py pickleoutput.db principal [principal ...]
+    A principal is a user or group email, a domain, or "anyone" (link sharing).
+    For a domain, every user and group in that domain is listed too.
+'''
+
+
+def print_access(access: PrincipalAccess, all_folders: FolderTracker, tracked_files: Dict[str, TrackedFile]):
+    print("** %s" % access)
+    paths: List[str] = []
+    for file_id in access.folder_ids:
+        folder = all_folders.static_folder_lookup(file_id, none_is_okay=True)
+        paths.append(folder.full_path + "/" if folder is not None else file_id)
+    for file_id in access.file_ids:
+        tracked_file = tracked_files[file_id]
+        paths.append(SafeFile.get_full_path(tracked_file.file, tracked_file.parent_folder))
+
+    for path in sorted(paths):
+        print("\t%s" % path)
+
+
+if __name__ == "__main__":
+    pf = open(sys.argv[1], "rb")
+    all_folders: FolderTracker = pickle.load(pf)
+    all_folders.restore_path_settings()
+    tracked_files: Dict[str, TrackedFile] = pickle.load(pf)
+    principal_index: PrincipalAccessIndex = pickle.load(pf)
+    pf.close()
+
+    for principal in sys.argv[2:]:
+        if "@" in principal or principal == "anyone":
+            found = [principal_index.lookup(principal)]
+        else:
+            found = principal_index.lookup_domain(principal)
+        found = [x for x in found if x is not None]
+
+        if len(found) == 0:
+            print("** %s: no access found" % principal)
+        for access in found:
+            print_access(access, all_folders, tracked_files)